@@ -1,16 +1,28 @@
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
 
-from scipy.ndimage import filters, measurements
-from scipy.ndimage.morphology import (
-    binary_dilation,
-    binary_fill_holes,
-    distance_transform_cdt,
-    distance_transform_edt,
-)
+from numba import njit, prange
+
+from scipy import ndimage
 
-from skimage.morphology import remove_small_objects, watershed
-from hover.misc.utils import get_bounding_box
+from skimage.morphology import watershed
+
+# optional GPU fast path for the filtering stage of __proc_np_hv, taken
+# automatically when CuPy sees the CUDA device already used for inference;
+# anything short of an importable cupy with a visible device (no driver,
+# CUDA_VISIBLE_DEVICES="", broken wheel) falls back to the CPU path
+try:
+    import cupy as cp
+    from cupyx.scipy.ndimage import correlate1d as cp_correlate1d
+
+    if cp.cuda.runtime.getDeviceCount() == 0:
+        cp = None
+except Exception:
+    cp = None
 
 import warnings
 
@@ -20,6 +32,165 @@ def noop(*args, **kargs):
 
 warnings.warn = noop
 
+# separable taps of the ksize=21 Sobel filters, computed once at import -
+# two 1D passes via sepFilter2D cost 42 muls/pixel vs 441 for the dense
+# 2D kernel, and fp32 halves the bandwidth of the previous CV_64F output
+_SOBEL_KERNELS_H = cv2.getDerivKernels(1, 0, ksize=21, ktype=cv2.CV_32F)
+_SOBEL_KERNELS_V = cv2.getDerivKernels(0, 1, ksize=21, ktype=cv2.CV_32F)
+
+# 5x5 elliptical structuring element for the marker opening, built once
+# rather than on every tile
+_MARKER_OPEN_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+
+# threads per process() call for contour tracing - capped low because
+# run.py already fans tiles out over a multiprocessing pool (10 workers by
+# default), so per-tile threads multiply with the process count
+_CONTOUR_WORKERS = min(4, os.cpu_count() or 1)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def __fuse_overall(sobelh, sobelv, blb, h_min, h_range, v_min, v_range, out):
+    """Fused kernel for the energy landscape of the watershed
+
+    Min-max normalizes both Sobel responses, inverts them, takes the
+    pixel-wise maximum, subtracts the background and clips at zero - all
+    in a single pass, reading and writing each pixel once rather than
+    streaming four full-image intermediates through memory.
+
+    Args:
+        sobelh: raw horizontal Sobel response
+        sobelv: raw vertical Sobel response
+        blb: binary nuclei map
+        h_min, h_range: minimum and value range of sobelh
+        v_min, v_range: minimum and value range of sobelv
+        out: preallocated fp32 output buffer
+
+    """
+    for i in prange(sobelh.shape[0]):
+        for j in range(sobelh.shape[1]):
+            h = 1.0 - (sobelh[i, j] - h_min) / h_range
+            v = 1.0 - (sobelv[i, j] - v_min) / v_range
+            val = max(h, v) - (1.0 - blb[i, j])
+            out[i, j] = val if val > 0.0 else 0.0
+
+
+def __hv_energy_gpu(h_dir, v_dir, blb):
+    """Compute the watershed energy map on the GPU
+
+    CuPy version of the sepFilter2D + __fuse_overall stage: the separable
+    Sobel passes and the normalize/invert/maximum/subtract/clip chain run
+    as device kernels and only the final HxW map is copied back to the
+    host, keeping the compute-heaviest part of post processing off the CPU.
+
+    The Sobel passes accumulate in fp32, then the elementwise chain runs
+    in fp16 to halve device bandwidth - the result only has to survive a
+    0.4 threshold and an 8-bit quantization, so half precision is ample.
+
+    Args:
+        h_dir: min-max normalized horizontal map, fp32
+        v_dir: min-max normalized vertical map, fp32
+        blb: binary nuclei map
+
+    Return:
+        fp32 energy map, matching the CPU path to fp16 precision
+
+    """
+    h_dir = cp.asarray(h_dir)
+    v_dir = cp.asarray(v_dir)
+    blb = cp.asarray(blb, dtype=cp.float16)
+    khx, khy = (cp.asarray(k.ravel()) for k in _SOBEL_KERNELS_H)
+    kvx, kvy = (cp.asarray(k.ravel()) for k in _SOBEL_KERNELS_V)
+    # mirror mode matches the reflect-101 border that sepFilter2D uses
+    sobelh = cp_correlate1d(
+        cp_correlate1d(h_dir, khx, axis=1, mode="mirror"), khy, axis=0, mode="mirror"
+    )
+    sobelv = cp_correlate1d(
+        cp_correlate1d(v_dir, kvx, axis=1, mode="mirror"), kvy, axis=0, mode="mirror"
+    )
+    sobelh = (
+        1 - (sobelh - sobelh.min()) / cp.maximum(sobelh.max() - sobelh.min(), 1e-12)
+    ).astype(cp.float16)
+    sobelv = (
+        1 - (sobelv - sobelv.min()) / cp.maximum(sobelv.max() - sobelv.min(), 1e-12)
+    ).astype(cp.float16)
+    overall = cp.maximum(sobelh, sobelv) - (1 - blb)
+    overall = cp.clip(overall, 0, None)
+    return cp.asnumpy(overall).astype(np.float32)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def __neg_gaussian_blur3(img, out):
+    """Fused 3x3 Gaussian blur and sign flip
+
+    Applies the separable [1, 2, 1] / 4 binomial kernel (what
+    cv2.GaussianBlur uses for ksize 3 with sigma 0) as two 1D passes and
+    negates the result in the second pass, so the blurred-and-inverted
+    map is produced without an extra full-image negation. Borders use
+    reflect-101, matching the OpenCV default.
+
+    Args:
+        img: 2D input
+        out: preallocated output buffer of the same shape and dtype
+
+    """
+    h, w = img.shape
+    tmp = np.empty_like(img)
+    for i in prange(h):
+        for j in range(w):
+            jl = 1 if j == 0 else j - 1
+            jr = w - 2 if j == w - 1 else j + 1
+            tmp[i, j] = 0.25 * (img[i, jl] + 2.0 * img[i, j] + img[i, jr])
+    for i in prange(h):
+        iu = 1 if i == 0 else i - 1
+        id = h - 2 if i == h - 1 else i + 1
+        for j in range(w):
+            out[i, j] = -0.25 * (tmp[iu, j] + 2.0 * tmp[i, j] + tmp[id, j])
+
+
+def __remove_small_objects(img, min_size):
+    """Remove connected components smaller than an area threshold
+
+    Stand-in for skimage.morphology.remove_small_objects - component areas
+    come from a single np.bincount over the label map and small labels are
+    zeroed through a lookup table, so the input labels are kept as-is and
+    no extra connected components pass is needed.
+
+    Args:
+        img: 2D labelled input, background is 0
+        min_size: minimum area (in pixels) of components to keep
+
+    Return:
+        labelled map with small components removed
+
+    """
+    areas = np.bincount(img.ravel())
+    lut = np.arange(areas.size, dtype=img.dtype)
+    lut[areas < min_size] = 0  # background is label 0 and stays 0
+    return lut[img]
+
+
+def __fill_holes(img):
+    """Fill enclosed holes within the foreground of a binary input
+
+    OpenCV stand-in for scipy.ndimage.binary_fill_holes - flood fill the
+    background from a padded border, then any pixel the fill cannot reach
+    is an enclosed hole.
+
+    Args:
+        img: 2D binary input
+
+    Return:
+        uint8 binary map with holes filled
+
+    """
+    img = np.array(img > 0, dtype=np.uint8)
+    canvas = np.zeros((img.shape[0] + 2, img.shape[1] + 2), dtype=np.uint8)
+    canvas[1:-1, 1:-1] = img
+    mask = np.zeros((img.shape[0] + 4, img.shape[1] + 4), dtype=np.uint8)
+    cv2.floodFill(canvas, mask, (0, 0), 1)
+    return img | (1 - canvas[1:-1, 1:-1])
+
+
 def __proc_np_hv(pred):
     """Process Nuclei Prediction with XY Coordinate Map
 
@@ -40,10 +211,10 @@ def __proc_np_hv(pred):
     v_dir_raw = pred[..., 2]
 
     # processing
-    blb = np.array(blb_raw >= 0.5, dtype=np.int32)
+    blb = cv2.threshold(blb_raw, 0.5, 1, cv2.THRESH_BINARY)[1].astype(np.uint8)
 
-    blb = measurements.label(blb)[0]
-    blb = remove_small_objects(blb, min_size=10)
+    blb = cv2.connectedComponents(blb, connectivity=4)[1]
+    blb = __remove_small_objects(blb, min_size=10)
     blb[blb > 0] = 1  # background is 0 already
 
     h_dir = cv2.normalize(
@@ -53,43 +224,101 @@ def __proc_np_hv(pred):
         v_dir_raw, None, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F
     )
 
-    sobelh = cv2.Sobel(h_dir, cv2.CV_64F, 1, 0, ksize=21)
-    sobelv = cv2.Sobel(v_dir, cv2.CV_64F, 0, 1, ksize=21)
+    if cp is not None:
+        overall = __hv_energy_gpu(h_dir, v_dir, blb)
+    else:
+        sobelh = cv2.sepFilter2D(h_dir, cv2.CV_32F, *_SOBEL_KERNELS_H)
+        sobelv = cv2.sepFilter2D(v_dir, cv2.CV_32F, *_SOBEL_KERNELS_V)
 
-    sobelh = 1 - (
-        cv2.normalize(
-            sobelh, None, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F
-        )
-    )
-    sobelv = 1 - (
-        cv2.normalize(
-            sobelv, None, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F
+        h_min, h_max = float(np.min(sobelh)), float(np.max(sobelh))
+        v_min, v_max = float(np.min(sobelv)), float(np.max(sobelv))
+        overall = np.empty_like(sobelh)
+        __fuse_overall(
+            sobelh,
+            sobelv,
+            blb,
+            h_min,
+            max(h_max - h_min, 1e-12),
+            v_min,
+            max(v_max - v_min, 1e-12),
+            overall,
         )
-    )
-
-    overall = np.maximum(sobelh, sobelv)
-    overall = overall - (1 - blb)
-    overall[overall < 0] = 0
 
-    dist = (1.0 - overall) * blb
+    # keep fp32 - multiplying by the int32 mask directly would promote to fp64
+    dist = (1.0 - overall) * blb.astype(np.float32)
     ## nuclei values form mountains so inverse to get basins
-    dist = -cv2.GaussianBlur(dist, (3, 3), 0)
+    dist_inv = np.empty_like(dist)
+    __neg_gaussian_blur3(dist, dist_inv)
+    dist = dist_inv
 
     overall = np.array(overall >= 0.4, dtype=np.int32)
 
     marker = blb - overall
     marker[marker < 0] = 0
-    marker = binary_fill_holes(marker).astype("uint8")
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-    marker = cv2.morphologyEx(marker, cv2.MORPH_OPEN, kernel)
-    marker = measurements.label(marker)[0]
-    marker = remove_small_objects(marker, min_size=10)
+    marker = __fill_holes(marker)
+    marker = cv2.morphologyEx(marker, cv2.MORPH_OPEN, _MARKER_OPEN_KERNEL)
+    marker = cv2.connectedComponents(marker, connectivity=4)[1]
+    marker = __remove_small_objects(marker, min_size=10)
 
+    # deliberately skimage, not cv2.watershed: cv2 has no mask argument, its
+    # background seeding floods into the nuclei across the 8-bit-quantized
+    # edge ramp (eroding every instance), and it unconditionally marks the
+    # outermost pixel ring as boundary - which becomes a background seam
+    # through nuclei straddling tile edges in the abutting-tile WSI path
     proced_pred = watershed(dist, marker, mask=blb)
 
     return proced_pred
 
 
+class InstInfo(object):
+    """Structure-of-arrays container for per-instance nuclear results
+
+    Stores centroids, types and class probabilities as flat preallocated
+    arrays indexed by instance position (plus a list for the
+    variable-length contours), so a consumer that needs a single field
+    reads one contiguous array instead of chasing per-instance dicts.
+
+    Args:
+        inst_ids: list of instance ids present in the label map
+        nr_types: number of types considered at output of nc branch
+
+    """
+
+    def __init__(self, inst_ids, nr_types=None):
+        nr_inst = len(inst_ids)
+        self.inst_ids = np.asarray(inst_ids, dtype=np.int32)
+        self.centroids = np.zeros((nr_inst, 2), dtype=np.float32)
+        self.contours = [None] * nr_inst
+        self.types = None
+        self.probs = None
+        if nr_types is not None:
+            self.types = np.zeros(nr_inst, dtype=np.int32)
+            self.probs = np.zeros((nr_inst, nr_types), dtype=np.float32)
+
+    def as_dict(self, return_probs=False):
+        """Convert to the per-instance dictionary format
+
+        Args:
+            return_probs: whether to include the per class probabilities
+
+        Return:
+            dictionary of instance-level nuclear results keyed by id
+
+        """
+        inst_info_dict = {}
+        for idx, inst_id in enumerate(self.inst_ids):
+            inst_info = {
+                "centroid": self.centroids[idx],
+                "contour": self.contours[idx],
+            }
+            if self.types is not None:
+                inst_info["type"] = int(self.types[idx])
+                if return_probs:
+                    inst_info["probs"] = self.probs[idx]
+            inst_info_dict[int(inst_id)] = inst_info
+        return inst_info_dict
+
+
 def process(pred_map, nr_types=None, return_dict=False, return_probs=False):
     """Post processing script for image tiles
 
@@ -115,66 +344,76 @@ def process(pred_map, nr_types=None, return_dict=False, return_probs=False):
     pred_inst = np.squeeze(pred_inst)
     pred_inst = __proc_np_hv(pred_inst)
 
-    inst_info_dict = None
+    inst_info = None
     if return_dict or nr_types is not None:
-        inst_id_list = np.unique(pred_inst)[1:]  # exlcude background
-        inst_info_dict = {}
-        inst_bbox_dict = {}
-        for idx, inst_id in enumerate(inst_id_list):
-            inst_map = pred_inst == inst_id
-            # TODO: change format of bbox output
-            rmin, rmax, cmin, cmax = get_bounding_box(inst_map)
-            inst_bbox = np.array([[rmin, cmin], [rmax, cmax]])
-            inst_map = inst_map[
-                inst_bbox[0][0] : inst_bbox[1][0], inst_bbox[0][1] : inst_bbox[1][1]
-            ]
+        # get all bounding boxes in a single pass over the label map, rather
+        # than scanning the full image once per instance
+        inst_slices = ndimage.find_objects(pred_inst)
+        inst_id_list = [
+            inst_id
+            for inst_id, inst_slice in enumerate(inst_slices, start=1)
+            if inst_slice is not None
+        ]
+        # centroids of every instance in one C-level sweep of the label map,
+        # instead of a cv2.moments call per instance
+        inst_centroids = ndimage.center_of_mass(
+            np.ones(pred_inst.shape, dtype=np.float32),
+            labels=pred_inst,
+            index=inst_id_list,
+        )
+        def get_inst_contour(inst_id):
+            inst_slice = inst_slices[inst_id - 1]
+            inst_map = pred_inst[inst_slice] == inst_id
             inst_map = inst_map.astype(np.uint8)
-            inst_moment = cv2.moments(inst_map)
             inst_contour = cv2.findContours(
                 inst_map, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE
             )
             # * opencv protocol format may break
             inst_contour = np.squeeze(inst_contour[0][0].astype("int32"))
-            inst_centroid = [
-                (inst_moment["m10"] / inst_moment["m00"]),
-                (inst_moment["m01"] / inst_moment["m00"]),
-            ]
-            inst_centroid = np.array(inst_centroid)
-            inst_contour[:, 0] += inst_bbox[0][1]  # X
-            inst_contour[:, 1] += inst_bbox[0][0]  # Y
-            inst_centroid[0] += inst_bbox[0][1]  # X
-            inst_centroid[1] += inst_bbox[0][0]  # Y
-            inst_info_dict[inst_id] = {  # inst_id should start at 1
-                "centroid": inst_centroid,
-                "contour": inst_contour,
-            }
-            inst_bbox_dict[inst_id] = {  # inst_id should start at 1
-                "bbox": inst_bbox
-            }
+            inst_contour[:, 0] += inst_slice[1].start  # X
+            inst_contour[:, 1] += inst_slice[0].start  # Y
+            return inst_contour
+
+        # findContours releases the GIL, so the disjoint per-instance crops
+        # can be traced concurrently by threads without any pickling; keep
+        # the pool small since process() already runs inside run.py's
+        # tile-level worker pool and every worker gets its own threads
+        with ThreadPoolExecutor(max_workers=_CONTOUR_WORKERS) as pool:
+            inst_contours = pool.map(get_inst_contour, inst_id_list)
 
+        inst_info = InstInfo(inst_id_list, nr_types)
+        inst_info.contours = list(inst_contours)
+        if inst_id_list:
+            # center_of_mass is (y, x) in full-image coordinates already
+            inst_info.centroids[:] = np.asarray(
+                inst_centroids, dtype=np.float32
+            )[:, ::-1]
 
     if nr_types is not None:
         #### * Get class of each instance id, stored at index id-1
+        # joint (instance, type) histogram over the two maps in one pass -
+        # replaces the per-instance crop masking and np.unique calls
+        type_freq = np.bincount(
+            pred_inst.ravel().astype(np.int64) * nr_types + pred_type.ravel(),
+            minlength=(int(pred_inst.max()) + 1) * nr_types,
+        ).reshape(-1, nr_types)
         for idx, inst_id in enumerate(inst_id_list):
-            rmin, cmin, rmax, cmax = (inst_bbox_dict[inst_id]["bbox"]).flatten()
-            inst_map_crop = pred_inst[rmin:rmax, cmin:cmax]
-            inst_type_crop = pred_type[rmin:rmax, cmin:cmax]
-            inst_map_crop = inst_map_crop == inst_id
-            inst_type = inst_type_crop[inst_map_crop]
-            type_list_, type_pixels_ = np.unique(inst_type, return_counts=True)
-            type_list = list(zip(type_list_, type_pixels_))
-            type_list = sorted(type_list, key=lambda x: x[1], reverse=True)
-            inst_type = type_list[0][0]
+            inst_freq = type_freq[inst_id]
+            # top-1 comes straight off the histogram row, no sort needed
+            inst_type = int(np.argmax(inst_freq))
             if inst_type == 0:  # ! pick the 2nd most dominant if it exists
-                if len(type_list) > 1:
-                    inst_type = type_list[1][0]
-            inst_info_dict[inst_id]["type"] = int(inst_type)
-            if return_probs:
-                type_list_ = type_list_.tolist()
-                nr_pix = np.sum(inst_map_crop)
-                inst_probs = np.zeros([nr_types])
-                for type_idx in type_list_:
-                    inst_probs[type_idx] = float(type_pixels_[type_list_.index(type_idx)] / nr_pix)
-                inst_info_dict[inst_id]["probs"] = inst_probs
+                if np.any(inst_freq[1:]):
+                    inst_type = 1 + int(np.argmax(inst_freq[1:]))
+            inst_info.types[idx] = inst_type
+
+        if return_probs and inst_id_list:
+            # every probability row is just the histogram row over its pixel
+            # count - one vectorized shot for all instances
+            inst_freqs = type_freq[inst_info.inst_ids]
+            inst_info.probs[:] = inst_freqs / inst_freqs.sum(axis=1, keepdims=True)
+
+    inst_info_dict = None
+    if inst_info is not None:
+        inst_info_dict = inst_info.as_dict(return_probs)
 
     return pred_inst, inst_info_dict